@@ -1,26 +1,55 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import itertools
 import os
+import select
 import socket
 import subprocess
 import sys
-import threading
-import time
 import uuid
 from importlib import import_module
 from unittest.mock import patch
 
+import eventlet
+import py
 import pytest
 from eventlet.green import zmq
+from google import protobuf
+from grpc_tools import protoc
 from mock import Mock
 from nameko import config
 from nameko.testing.services import dummy
-from nameko.testing.utils import find_free_port, get_extension
+from nameko.testing.utils import get_extension
 
 from nameko_grpc.client import Client
+from nameko_grpc.constants import Cardinality
 from nameko_grpc.dependency_provider import GrpcProxy
 from nameko_grpc.inspection import Inspector
 
-from helpers import Command, RemoteClientTransport, Stash
+from helpers import Command, Multiplexer, RemoteClientTransport, Stash, TransportPool
+
+
+try:
+    from importlib.metadata import version
+except ImportError:  # python < 3.8
+    from importlib_metadata import version
+
+
+PYTHON = sys.executable
+
+SERVER_STARTUP_TIMEOUT = 10
+
+PROCESS_TERMINATE_TIMEOUT = 0.5
+
+WELL_KNOWN_PROTOS_PATH = os.path.join(os.path.dirname(protoc.__file__), "_proto")
+
+GRPC_PORT_POOL_SIZE = 16
+
+CLIENT_TYPES = ("grpc", "nameko", "dp")
+
+SERVER_TYPES = ("grpc", "nameko")
+
+context = zmq.Context.instance()
 
 
 def pytest_addoption(parser):
@@ -44,61 +73,147 @@ def pytest_addoption(parser):
     )
 
 
+def pytest_generate_tests(metafunc):
+    """Parametrize tests over the client and server types requested with the
+    `--client` and `--server` options.
+
+    Test classes can restrict the types they run against by setting `client_types`
+    or `server_types`.
+    """
+    for name, all_types in (("client", CLIENT_TYPES), ("server", SERVER_TYPES)):
+        argname = "{}_type".format(name)
+        if argname not in metafunc.fixturenames:
+            continue
+
+        requested = getattr(metafunc.config.option, name)
+        types = [
+            type_
+            for type_ in getattr(metafunc.cls, "{}_types".format(name), all_types)
+            if requested in (type_, "all")
+        ]
+        metafunc.parametrize(
+            argname, types, ids=["{}={}".format(name, type_) for type_ in types]
+        )
+
+
 @pytest.fixture(scope="session")
-def spec_dir(tmpdir_factory):
-    master = os.path.join(os.path.dirname(__file__), "spec")
-    temp = tmpdir_factory.mktemp("spec")
-    for filename in os.listdir(master):
-        path = os.path.join(master, filename)
-        if os.path.isfile(path):
-            copy = temp.join(filename)
-            with open(path) as file:
-                copy.write(file.read())
+def spec_dir():
+    spec = py.path.local(__file__).dirpath("spec")
 
-    sys.path.append(temp.strpath)
-    yield temp
-    sys.path.remove(temp.strpath)
+    sys.path.append(spec.strpath)
+    yield spec
+    sys.path.remove(spec.strpath)
 
 
 @pytest.fixture(scope="session")
-def compile_proto(spec_dir):
+def codegen_cache_dir(request, spec_dir, tmpdir_factory):
+    """Directory for code generated from the protos in `spec_dir`.
 
-    spec_path = spec_dir.strpath
+    Generated code is kept in the pytest cache, keyed by a hash of the protos and the
+    protobuf and grpcio-tools versions, so it's reused until any of those change.
+    Falls back to a temporary directory if the cache is disabled.
+
+    The cache is shared between sessions, so tests must use the copy in `codegen_dir`
+    instead.
+    """
+    digest = hashlib.blake2b(digest_size=32)
+    digest.update(protobuf.__version__.encode("utf-8"))
+    digest.update(version("grpcio-tools").encode("utf-8"))
+    for proto in sorted(spec_dir.listdir("*.proto")):
+        digest.update(proto.basename.encode("utf-8"))
+        digest.update(proto.read_binary())
+
+    cache = getattr(request.config, "cache", None)
+    if cache is not None:
+        return cache.makedir("codegen").ensure(digest.hexdigest(), dir=True)
+    return tmpdir_factory.mktemp("codegen-cache")
 
-    def codegen(proto_name):
 
-        proto_path = os.path.join(spec_path, "{}.proto".format(proto_name))
-        proto_last_modified = os.path.getmtime(proto_path)
+@pytest.fixture(autouse=True, scope="session")
+def compiled_protos(spec_dir, codegen_cache_dir):
+    """Generate code for every proto in `spec_dir` that's missing or out of date."""
+
+    stale_protos = []
+    for proto in spec_dir.listdir("*.proto"):
+        proto_name = proto.purebasename
 
         for generated_file in (
             "{}_pb2.py".format(proto_name),
             "{}_pb2_grpc.py".format(proto_name),
         ):
-            generated_path = os.path.join(spec_path, generated_file)
-            if (
-                not os.path.exists(generated_path)
-                or os.path.getmtime(generated_path) < proto_last_modified
-            ):
-                protoc_args = [
-                    "-I{}".format(spec_path),
-                    "--python_out",
-                    spec_path,
-                    "--grpc_python_out",
-                    spec_path,
-                    proto_path,
-                ]
-                # protoc.main is confused by absolute paths, so use subprocess instead
-                python_args = ["python", "-m", "grpc_tools.protoc"] + protoc_args
-                subprocess.call(python_args)
-
-        protobufs = import_module("{}_pb2".format(proto_name))
-        stubs = import_module("{}_pb2_grpc".format(proto_name))
-
-        return protobufs, stubs
+            generated = codegen_cache_dir.join(generated_file)
+            if not generated.exists() or generated.mtime() < proto.mtime():
+                stale_protos.append(proto.basename)
+                break
+
+    if not stale_protos:
+        return
+
+    # run protoc once, in-process, with input paths relative to the spec directory.
+    # `python -m grpc_tools.protoc` adds the include path for the well-known types,
+    # but `protoc.main` does not
+    codegen_path = codegen_cache_dir.strpath
+    protoc_args = [
+        "grpc_tools.protoc",
+        "-I.",
+        "-I{}".format(WELL_KNOWN_PROTOS_PATH),
+        "--python_out",
+        codegen_path,
+        "--grpc_python_out",
+        codegen_path,
+    ]
+    protoc_args.extend(stale_protos)
+    with spec_dir.as_cwd():
+        returncode = protoc.main(protoc_args)
+    if returncode != 0:
+        raise RuntimeError(
+            "protoc failed to generate code for {}".format(", ".join(stale_protos))
+        )
+
+
+@pytest.fixture(scope="session")
+def codegen_dir(compiled_protos, codegen_cache_dir, tmpdir_factory):
+    """Private copy of the generated code for this session.
+
+    Some tests modify the generated code, which mustn't leak into the cache.
+    """
+    codegen = tmpdir_factory.mktemp("codegen")
+    for generated in codegen_cache_dir.listdir("*.py"):
+        generated.copy(codegen)
+
+    sys.path.insert(0, codegen.strpath)
+    yield codegen
+    sys.path.remove(codegen.strpath)
+
+
+@pytest.fixture(scope="session")
+def compile_proto(codegen_dir):
+
+    # generated modules, keyed by proto name
+    cache = {}
+
+    def codegen(proto_name):
+
+        if proto_name not in cache:
+            protobufs = import_module("{}_pb2".format(proto_name))
+            stubs = import_module("{}_pb2_grpc".format(proto_name))
+            cache[proto_name] = protobufs, stubs
+
+        return cache[proto_name]
 
     return codegen
 
 
+@pytest.fixture(scope="session")
+def spec_env(spec_dir, codegen_dir):
+    """Environment for subprocesses that need to import from `spec_dir`, and the
+    code generated from it.
+    """
+    env = os.environ.copy()
+    env["PYTHONPATH"] = os.pathsep.join([codegen_dir.strpath, spec_dir.strpath])
+    return env
+
+
 @pytest.fixture(scope="session")
 def load_protobufs(compile_proto):
     def load(name):
@@ -117,36 +232,65 @@ def load_stubs(compile_proto):
     return load
 
 
-@pytest.fixture(autouse=True, scope="session")
-def example_proto(compile_proto):
-    compile_proto("example")
-
-
 @pytest.fixture
 def spawn_process():
 
     procs = []
 
-    def spawn(*args, env=None):
-        popen_args = [sys.executable]
-        popen_args.extend(args)
-        procs.append(subprocess.Popen(popen_args, env=env))
+    def spawn(*args, env=None, pass_fds=()):
+        # pass file descriptors by inheritance rather than with Popen's `pass_fds`,
+        # which implies `close_fds` and so rules out the faster posix_spawn path
+        for fd in pass_fds:
+            os.set_inheritable(fd, True)
+
+        popen_args = (PYTHON, *map(str, args))
+        procs.append(subprocess.Popen(popen_args, env=env, close_fds=False))
 
     yield spawn
 
     for proc in procs:
         proc.terminate()
 
+    # reap the processes so their resources are released before the next test
+    for proc in procs:
+        try:
+            proc.wait(PROCESS_TERMINATE_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+
+
+@pytest.fixture(scope="session")
+def grpc_ports():
+    """Cycle through a pool of free ports, grabbed once for the whole session.
+
+    The sockets are all bound before any are closed, so the ports are distinct.
+    """
+    socks = []
+    for _ in range(GRPC_PORT_POOL_SIZE):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        socks.append(sock)
+
+    ports = [sock.getsockname()[1] for sock in socks]
+    for sock in socks:
+        sock.close()
+
+    return itertools.cycle(ports)
+
 
 @pytest.fixture
-def grpc_port():
-    return find_free_port()
+def grpc_port(grpc_ports):
+    return next(grpc_ports)
 
 
 @pytest.fixture
-def start_grpc_server(request, compile_proto, spawn_process, spec_dir, grpc_port):
+def secure(request):
+    return request.node.get_closest_marker(name="secure") is not None
+
 
-    secure = "secure" if request.node.get_closest_marker(name="secure") else "insecure"
+@pytest.fixture
+def start_grpc_server(spawn_process, spec_env, grpc_port, secure):
 
     server_script = os.path.join(os.path.dirname(__file__), "grpc_indirect_server.py")
 
@@ -159,99 +303,119 @@ def start_grpc_server(request, compile_proto, spawn_process, spec_dir, grpc_port
         if proto_name is None:
             proto_name = service_name
 
-        env = os.environ.copy()
-        env["PYTHONPATH"] = spec_dir.strpath
+        # the server writes to this pipe once it's accepting connections
+        ready_fd, server_ready_fd = os.pipe()
 
         spawn_process(
             server_script,
-            str(grpc_port),
-            secure,
+            grpc_port,
+            "secure" if secure else "insecure",
             proto_name,
             service_name,
             compression_algorithm,
             compression_level,
-            env=env,
+            server_ready_fd,
+            env=spec_env,
+            pass_fds=(server_ready_fd,),
         )
+        os.close(server_ready_fd)
 
         # wait for server to start
-        while True:
-            try:
-                sock = socket.socket()
-                sock.connect(("127.0.0.1", grpc_port))
-                sock.close()
-                break
-            except socket.error:
-                time.sleep(0.1)
+        try:
+            readable, _, _ = select.select([ready_fd], [], [], SERVER_STARTUP_TIMEOUT)
+            if not readable or not os.read(ready_fd, 1):
+                raise RuntimeError("grpc server failed to start")
+        finally:
+            os.close(ready_fd)
 
     yield make
 
 
-@pytest.fixture
-def start_grpc_client(request, load_stubs, spawn_process, spec_dir, grpc_port):
+class IndirectResult:
+    _metadata = None
 
-    secure = "secure" if request.node.get_closest_marker(name="secure") else "insecure"
+    def __init__(self, command):
+        self.command = command
 
-    client_script = os.path.join(os.path.dirname(__file__), "grpc_indirect_client.py")
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self._metadata = self.command.get_metadata()
+        return self._metadata
 
-    clients = []
+    def code(self):
+        return self.metadata.get("code")
 
-    context = zmq.Context()
+    def details(self):
+        return self.metadata.get("details")
 
-    class Result:
-        _metadata = None
+    def initial_metadata(self):
+        return self.metadata.get("initial_metadata")
 
-        def __init__(self, command):
-            self.command = command
+    def trailing_metadata(self):
+        return self.metadata.get("trailing_metadata")
 
-        @property
-        def metadata(self):
-            if self._metadata is None:
-                self._metadata = self.command.get_metadata()
-            return self._metadata
+    def result(self):
+        return self.command.get_response()
 
-        def code(self):
-            return self.metadata.get("code")
 
-        def details(self):
-            return self.metadata.get("details")
+class IndirectMethod:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
 
-        def initial_metadata(self):
-            return self.metadata.get("initial_metadata")
+    def __call__(self, request, **kwargs):
+        return self.future(request, **kwargs).result()
 
-        def trailing_metadata(self):
-            return self.metadata.get("trailing_metadata")
+    def future(self, request, **kwargs):
+        cardinality = self.client.inspector.cardinality_for_method(self.name)
+
+        command = Command(
+            self.name,
+            cardinality,
+            kwargs,
+            self.client.transport,
+            self.client.requests,
+            self.client.pool,
+        )
+        command.issue()
+        if cardinality in (Cardinality.STREAM_UNARY, Cardinality.STREAM_STREAM):
+            eventlet.spawn_n(command.send_request, request)
+        else:
+            command.send_request(request)
+        return IndirectResult(command)
 
-        def result(self):
-            return self.command.get_response()
 
-    class Method:
-        def __init__(self, client, name):
-            self.client = client
-            self.name = name
+class IndirectClient:
+    """Proxy for a standard gRPC client running in a separate process.
 
-        def __call__(self, request, **kwargs):
-            return self.future(request, **kwargs).result()
+    Mimics the interface of the standard client, issuing a `Command` to the remote
+    client for each method call.
+    """
 
-        def future(self, request, **kwargs):
-            inspector = Inspector(self.client.stub)
+    def __init__(self, stub, transport, requests):
+        self.stub = stub
+        self.inspector = Inspector(stub)
+        self.transport = transport
+        self.requests = requests
+        # response and metadata sockets are reused between commands
+        self.pool = TransportPool(context, zmq.PULL)
 
-            cardinality = inspector.cardinality_for_method(self.name)
+    def __getattr__(self, name):
+        return IndirectMethod(self, name)
 
-            command = Command(self.name, cardinality, kwargs, self.client.transport)
-            command.issue()
-            threading.Thread(target=command.send_request, args=(request,)).start()
-            return Result(command)
+    def shutdown(self):
+        self.transport.send(Command.END, close=True)
+        self.requests.close()
+        self.pool.close()
 
-    class Client:
-        def __init__(self, stub, transport):
-            self.stub = stub
-            self.transport = transport
 
-        def __getattr__(self, name):
-            return Method(self, name)
+@pytest.fixture
+def start_grpc_client(load_stubs, spawn_process, spec_env, grpc_port, secure):
 
-        def shutdown(self):
-            self.transport.send(Command.END, close=True)
+    client_script = os.path.join(os.path.dirname(__file__), "grpc_indirect_client.py")
+
+    clients = []
 
     def make(
         service_name,
@@ -265,26 +429,27 @@ def start_grpc_client(request, load_stubs, spawn_process, spec_dir, grpc_port):
         stubs = load_stubs(proto_name)
         stub_cls = getattr(stubs, "{}Stub".format(service_name))
 
-        transport, zmq_port = RemoteClientTransport.bind_to_free_port(
-            context, zmq.REQ, "tcp://127.0.0.1"
+        transport, endpoint = RemoteClientTransport.bind_to_free_endpoint(
+            context, zmq.REQ
+        )
+        requests, requests_endpoint = RemoteClientTransport.bind_to_free_endpoint(
+            context, zmq.PUSH
         )
-
-        env = os.environ.copy()
-        env["PYTHONPATH"] = spec_dir.strpath
 
         spawn_process(
             client_script,
-            str(grpc_port),
-            secure,
+            grpc_port,
+            "secure" if secure else "insecure",
             proto_name,
             service_name,
             compression_algorithm,
             compression_level,
-            str(zmq_port),
-            env=env,
+            endpoint,
+            requests_endpoint,
+            env=spec_env,
         )
 
-        client = Client(stub_cls, transport)
+        client = IndirectClient(stub_cls, transport, Multiplexer(requests))
         clients.append(client)
         return client
 
@@ -296,9 +461,9 @@ def start_grpc_client(request, load_stubs, spawn_process, spec_dir, grpc_port):
 
 
 @pytest.fixture
-def start_nameko_server(request, spec_dir, container_factory, grpc_port):
+def start_nameko_server(spec_dir, container_factory, grpc_port, secure):
 
-    if request.node.get_closest_marker(name="secure"):
+    if secure:
         ssl_options = {
             "cert_chain": {
                 "keyfile": "test/certs/server.key",
@@ -338,11 +503,11 @@ def start_nameko_server(request, spec_dir, container_factory, grpc_port):
 
 
 @pytest.fixture
-def start_nameko_client(request, load_stubs, spec_dir, grpc_port):
+def start_nameko_client(load_stubs, spec_dir, grpc_port, secure):
 
     clients = []
 
-    if request.node.get_closest_marker(name="secure"):
+    if secure:
         ssl_options = {"verify_mode": "none", "check_hostname": False}
     else:
         ssl_options = False
@@ -379,12 +544,12 @@ def start_nameko_client(request, load_stubs, spec_dir, grpc_port):
 
 @pytest.fixture
 def start_dependency_provider(
-    request, load_stubs, spec_dir, grpc_port, container_factory
+    load_stubs, spec_dir, grpc_port, container_factory, secure
 ):
 
     clients = []
 
-    if request.node.get_closest_marker(name="secure"):
+    if secure:
         ssl_config = {"verify_mode": "none", "check_hostname": False}
     else:
         ssl_config = False
@@ -433,41 +598,21 @@ def start_dependency_provider(
         client.stop()
 
 
-@pytest.fixture(params=["server=grpc", "server=nameko"])
-def server_type(request):
-    return request.param[7:]
-
-
 @pytest.fixture
 def start_server(request, server_type):
     if server_type == "grpc":
-        if request.config.option.server not in ("grpc", "all"):
-            pytest.skip("grpc server not requested")
         return request.getfixturevalue("start_grpc_server")
     if server_type == "nameko":
-        if request.config.option.server not in ("nameko", "all"):
-            pytest.skip("nameko server not requested")
         return request.getfixturevalue("start_nameko_server")
 
 
-@pytest.fixture(params=["client=grpc", "client=nameko", "client=dp"])
-def client_type(request):
-    return request.param[7:]
-
-
 @pytest.fixture
 def start_client(request, client_type, start_server):
     if client_type == "grpc":
-        if request.config.option.client not in ("grpc", "all"):
-            pytest.skip("grpc client not requested")
         return request.getfixturevalue("start_grpc_client")
     if client_type == "nameko":
-        if request.config.option.client not in ("nameko", "all"):
-            pytest.skip("nameko client not requested")
         return request.getfixturevalue("start_nameko_client")
     if client_type == "dp":
-        if request.config.option.client not in ("dp", "all"):
-            pytest.skip("dp client not requested")
         return request.getfixturevalue("start_dependency_provider")
 
 
@@ -10,7 +10,7 @@ from grpc._cython.cygrpc import CompressionAlgorithm, CompressionLevel
 from nameko_grpc.constants import Cardinality
 from nameko_grpc.errors import GrpcError
 
-from helpers import Command, RemoteClientTransport, status_from_metadata
+from helpers import Command, Multiplexer, RemoteClientTransport, status_from_metadata
 
 
 def execute(command, stub):
@@ -68,7 +68,8 @@ if __name__ == "__main__":
     grpc_module = import_module("{}_pb2_grpc".format(proto_name))
     stub_cls = getattr(grpc_module, "{}Stub".format(service_name))
 
-    zmq_port = sys.argv[7]
+    endpoint = sys.argv[7]
+    requests_endpoint = sys.argv[8]
 
     channel_options = [
         (
@@ -93,9 +94,15 @@ if __name__ == "__main__":
         )
     stub = stub_cls(channel)
 
-    transport = RemoteClientTransport.connect(
-        zmq.Context(), zmq.REP, "tcp://127.0.0.1:{}".format(zmq_port)
+    context = zmq.Context()
+
+    transport = RemoteClientTransport.connect(context, zmq.REP, endpoint)
+
+    # requests for all commands arrive over a single connection
+    requests = Multiplexer(
+        RemoteClientTransport.connect(context, zmq.PULL, requests_endpoint)
     )
+    threading.Thread(target=requests.dispatch, daemon=True).start()
 
-    for command in Command.retrieve_commands(transport):
+    for command in Command.retrieve_commands(transport, requests):
         threading.Thread(target=execute, args=(command, stub)).start()
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import os
 import sys
 import time
 from concurrent import futures
@@ -23,6 +24,8 @@ if __name__ == "__main__":
     compression_algorithm = sys.argv[5]
     compression_level = sys.argv[6]
 
+    ready_fd = int(sys.argv[7])
+
     service_module = import_module("{}_grpc".format(proto_name))
     service_cls = getattr(service_module, service_name)
 
@@ -59,6 +62,11 @@ if __name__ == "__main__":
             server.add_insecure_port("[::]:{}".format(port))
 
         server.start()
+
+        # signal readiness to the parent process
+        os.write(ready_fd, b"1")
+        os.close(ready_fd)
+
         try:
             while True:
                 time.sleep(_ONE_DAY_IN_SECONDS)
@@ -3,8 +3,12 @@ import base64
 import json
 import os
 import pickle
+import queue
+import sys
+import tempfile
 import threading
 import time
+import uuid
 
 import grpc
 import wrapt
@@ -65,8 +69,10 @@ class RemoteClientTransport:
 
     ENDSTREAM = "endstream"
 
-    def __init__(self, sock):
+    def __init__(self, sock, pool=None, ipc_path=None):
         self.sock = sock
+        self.pool = pool
+        self.ipc_path = ipc_path
 
     @classmethod
     def bind(cls, context, socket_type, target):
@@ -78,10 +84,24 @@ class RemoteClientTransport:
         return RemoteClientTransport(socket)
 
     @classmethod
-    def bind_to_free_port(cls, context, socket_type, target):
+    def bind_to_free_endpoint(cls, context, socket_type):
+        """Create a new transport over a ZMQ socket of type `socket_type`, bound
+        to a new local endpoint.
+
+        The endpoint is an IPC socket in the temp directory where IPC is supported,
+        and a TCP port on localhost chosen by the OS otherwise.
+        """
         socket = context.socket(socket_type)
-        port = socket.bind_to_random_port(target)
-        return RemoteClientTransport(socket), port
+        if sys.platform == "win32":
+            ipc_path = None
+            socket.bind("tcp://127.0.0.1:*")
+        else:
+            ipc_path = os.path.join(
+                tempfile.gettempdir(), "nameko-grpc-{}.sock".format(uuid.uuid4().hex)
+            )
+            socket.bind("ipc://{}".format(ipc_path))
+        endpoint = socket.getsockopt_string(zmq.LAST_ENDPOINT)
+        return RemoteClientTransport(socket, ipc_path=ipc_path), endpoint
 
     @classmethod
     def connect(cls, context, socket_type, target):
@@ -97,7 +117,7 @@ class RemoteClientTransport:
         return self.sock.context
 
     def receive(self, close=False):
-        loaded = pickle.loads(self.sock.recv())
+        loaded = pickle.loads(self._recv())
         try:
             if isinstance(loaded, GrpcError):
                 raise loaded
@@ -115,7 +135,7 @@ class RemoteClientTransport:
         self.close()
 
     def send(self, result, close=False):
-        self.sock.send(pickle.dumps(result))
+        self._send(pickle.dumps(result))
         if close:
             self.close()
 
@@ -132,7 +152,114 @@ class RemoteClientTransport:
         self.send(self.ENDSTREAM, close=True)
 
     def close(self):
+        if self.pool is not None:
+            self.pool.release(self)
+        else:
+            self.destroy()
+
+    def destroy(self):
+        """Close the underlying socket, removing its IPC endpoint if it has one."""
         self.sock.close()
+        if self.ipc_path is not None:
+            os.unlink(self.ipc_path)
+
+    def _recv(self):
+        return self.sock.recv()
+
+    def _send(self, data):
+        self.sock.send(data)
+
+
+class Channel(RemoteClientTransport):
+    """One of many transports multiplexed over the socket of a `Multiplexer`.
+
+    Messages sent on the channel are framed with its `key`. Messages received for the
+    channel are queued by the multiplexer until they're read.
+    """
+
+    def __init__(self, multiplexer, key):
+        super().__init__(multiplexer.sock)
+        self.multiplexer = multiplexer
+        self.key = key
+        self.queue = queue.Queue()
+
+    def close(self):
+        self.multiplexer.discard(self.key)
+
+    def _recv(self):
+        return self.queue.get()
+
+    def _send(self, data):
+        # streaming requests may outlive the multiplexer; drop anything sent once
+        # its socket is closed
+        if not self.sock.closed:
+            self.sock.send_multipart([self.key, data])
+
+
+class Multiplexer:
+    """Multiplexes keyed `Channel`s over the socket of a single transport.
+
+    Received messages are dispatched to their channels by `dispatch`, which should be
+    run in a background thread.
+    """
+
+    def __init__(self, transport):
+        self.transport = transport
+        self.sock = transport.sock
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def channel(self, key):
+        with self.lock:
+            if key not in self.channels:
+                self.channels[key] = Channel(self, key)
+            return self.channels[key]
+
+    def discard(self, key):
+        with self.lock:
+            self.channels.pop(key, None)
+
+    def dispatch(self):
+        while True:
+            key, data = self.sock.recv_multipart()
+            self.channel(key).queue.put(data)
+
+    def close(self):
+        self.transport.destroy()
+
+
+class TransportPool:
+    """Pool of `RemoteClientTransport`s of type `socket_type`, bound to free endpoints.
+
+    Closing a transport that was checked out of the pool returns it to the pool,
+    leaving the underlying socket bound and ready to be reused.
+    """
+
+    def __init__(self, context, socket_type):
+        self.context = context
+        self.socket_type = socket_type
+
+        self.endpoints = {}
+        self.idle = queue.LifoQueue()
+
+    def checkout(self):
+        """Return an idle transport and its endpoint, binding a new one if required."""
+        try:
+            transport = self.idle.get_nowait()
+        except queue.Empty:
+            transport, endpoint = RemoteClientTransport.bind_to_free_endpoint(
+                self.context, self.socket_type
+            )
+            transport.pool = self
+            self.endpoints[transport] = endpoint
+        return transport, self.endpoints[transport]
+
+    def release(self, transport):
+        self.idle.put(transport)
+
+    def close(self):
+        for transport in self.endpoints:
+            transport.destroy()
 
 
 class Command:
@@ -143,6 +270,9 @@ class Command:
     Issuing a command involves serializing it with pickle and sending it to the
     remote client via ZeroMQ (serialization is by a `RemoteClientTransport`)
 
+    Requests for every command issued to a remote client are multiplexed over a single
+    connection, the `requests` `Multiplexer`, using the command's `id` as the key.
+
     At the remote client, the received `Command` can be used to receive the request to
     issue to the GRPC server, and to return the response from the server to the caller.
 
@@ -161,15 +291,19 @@ class Command:
         ISSUE = "issue"
         RESPOND = "respond"
 
-    def __init__(self, method_name, cardinality, kwargs, transport):
+    def __init__(
+        self, method_name, cardinality, kwargs, transport, requests, pool=None
+    ):
+        self.id = uuid.uuid4().bytes
         self.method_name = method_name
         self.cardinality = cardinality
         self.kwargs = kwargs
         self.transport = transport
+        self.requests = requests
+        self.pool = pool
 
-        self.request_port = None
-        self.response_port = None
-        self.metadata_port = None
+        self.response_endpoint = None
+        self.metadata_endpoint = None
 
         self._request_transport = None
         self._response_transport = None
@@ -181,6 +315,8 @@ class Command:
         # remove the local transports before pickling
         state = self.__dict__.copy()
         state["transport"] = None
+        state["requests"] = None
+        state["pool"] = None
         state["_request_transport"] = None
         state["_response_transport"] = None
         state["_metadata_transport"] = None
@@ -199,7 +335,7 @@ class Command:
         if self.mode is not Command.Modes.ISSUE:
             raise ValueError("Command must be in ISSUE mode to be issued")
 
-        # ensure transports are established and bound to ports before transmitting
+        # ensure transports are established and bound to endpoints before transmitting
         assert self.request_transport
         assert self.response_transport
         assert self.metadata_transport
@@ -208,8 +344,11 @@ class Command:
         assert self.transport.receive() is True
 
     @staticmethod
-    def retrieve_commands(transport):
-        """Retrieve a series of commands over the given `transport`"""
+    def retrieve_commands(transport, requests):
+        """Retrieve a series of commands over the given `transport`
+
+        Requests for the commands are received over the `requests` `Multiplexer`.
+        """
         # this is actually just receive_stream...
         while True:
             command = transport.receive()
@@ -217,37 +356,37 @@ class Command:
                 break
             assert isinstance(command, Command)
             command.transport = transport
+            command.requests = requests
             yield command
             transport.send(True)
         transport.close()
 
     def bind_transport(self, socket_type):
-        """Bind a new transport using the given `socket_type`."""
-        transport, port = RemoteClientTransport.bind_to_free_port(
-            self.transport.context, socket_type, "tcp://127.0.0.1"
+        """Bind a new transport using the given `socket_type`.
+
+        If this command has a `pool` of transports of the same type, one is checked
+        out of the pool instead.
+        """
+        if self.pool is not None and self.pool.socket_type == socket_type:
+            return self.pool.checkout()
+
+        transport, endpoint = RemoteClientTransport.bind_to_free_endpoint(
+            self.transport.context, socket_type
         )
-        return transport, port
+        return transport, endpoint
 
-    def connect_transport(self, socket_type, port):
-        """Connect a new transport to `port` using the given `socket_type`."""
+    def connect_transport(self, socket_type, endpoint):
+        """Connect a new transport to `endpoint` using the given `socket_type`."""
         transport = RemoteClientTransport.connect(
-            self.transport.context, socket_type, "tcp://127.0.0.1:{}".format(port)
+            self.transport.context, socket_type, endpoint
         )
         return transport
 
     @property
     def request_transport(self):
-        """Bind or connect the request transport.
-
-        Depending on the mode of this command, either binds a new transport to a free
-        port, or connects to the established port.
-        """
+        """The channel for this command on the `requests` multiplexer."""
         if self._request_transport is None:
-            if self.mode is Command.Modes.ISSUE:
-                transport, self.request_port = self.bind_transport(zmq.PUSH)
-            else:
-                transport = self.connect_transport(zmq.PULL, self.request_port)
-            self._request_transport = transport
+            self._request_transport = self.requests.channel(self.id)
         return self._request_transport
 
     @property
@@ -255,13 +394,13 @@ class Command:
         """Bind or connect the response transport.
 
         Depending on the mode of this command, either binds a new transport to a free
-        port, or connects to the established port.
+        endpoint, or connects to the established endpoint.
         """
         if self._response_transport is None:
             if self.mode is Command.Modes.ISSUE:
-                transport, self.response_port = self.bind_transport(zmq.PULL)
+                transport, self.response_endpoint = self.bind_transport(zmq.PULL)
             else:
-                transport = self.connect_transport(zmq.PUSH, self.response_port)
+                transport = self.connect_transport(zmq.PUSH, self.response_endpoint)
             self._response_transport = transport
         return self._response_transport
 
@@ -270,28 +409,29 @@ class Command:
         """Bind or connect the metadata transport.
 
         Depending on the mode of this command, either binds a new transport to a free
-        port, or connects to the established port.
+        endpoint, or connects to the established endpoint.
         """
         if self._metadata_transport is None:
             if self.mode is Command.Modes.ISSUE:
-                transport, self.metadata_port = self.bind_transport(zmq.PULL)
+                transport, self.metadata_endpoint = self.bind_transport(zmq.PULL)
             else:
-                transport = self.connect_transport(zmq.PUSH, self.metadata_port)
+                transport = self.connect_transport(zmq.PUSH, self.metadata_endpoint)
             self._metadata_transport = transport
         return self._metadata_transport
 
     def send_request(self, request):
         """Send the request for this command to the remote client.
 
+        Streaming requests are sent synchronously, so callers should run this in the
+        background if the request stream may block.
+
         Only available in ISSUE mode.
         """
         if self.mode is not Command.Modes.ISSUE:
             raise ValueError("Command must be in ISSUE mode to send request")
 
         if self.cardinality in (Cardinality.STREAM_UNARY, Cardinality.STREAM_STREAM):
-            threading.Thread(
-                target=self.request_transport.send_stream, args=(request,)
-            ).start()
+            self.request_transport.send_stream(request)
         else:
             self.request_transport.send(request, close=True)
 
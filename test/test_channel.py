@@ -3,7 +3,6 @@
 import gc
 
 import objgraph
-import pytest
 
 from nameko_grpc.client import Client
 
@@ -12,9 +11,7 @@ class TestDisposeServerConnectionOnExit:
 
     COUNT = 10
 
-    @pytest.fixture(params=["server=nameko"])
-    def server_type(self, request):
-        return request.param[7:]
+    server_types = ("nameko",)
 
     def test_dispose(self, server, load_stubs, spec_dir, grpc_port, protobufs):
         """Regression test for server connection part of
@@ -52,9 +49,7 @@ class TestDisposeServerConnectionOnExit:
 class TestDisposeClientConnectionOnExit:
     COUNT = 10
 
-    @pytest.fixture(params=["server=nameko"])
-    def server_type(self, request):
-        return request.param[7:]
+    server_types = ("nameko",)
 
     def test_dispose(self, server, load_stubs, spec_dir, grpc_port, protobufs):
         """Regression test for client connection part of
@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-import pytest
 from nameko.testing.utils import get_extension
 from nameko.testing.waiting import wait_for_call
 
@@ -8,9 +7,7 @@ from nameko_grpc.entrypoint import GrpcServer
 
 
 class TestCloseSocketOnClientExit:
-    @pytest.fixture(params=["server=nameko"])
-    def server_type(self, request):
-        return request.param[7:]
+    server_types = ("nameko",)
 
     def test_close_socket(self, server, load_stubs, spec_dir, grpc_port, protobufs):
         """Regression test for https://github.com/nameko/nameko-grpc/issues/39"""
@@ -19,10 +19,8 @@ def protobufs(load_protobufs):
 
 
 class TestContextData:
-    @pytest.fixture(params=["server=nameko"])
-    def server_type(self, request):
-        # only nameko server supports the features in this test
-        return request.param[7:]
+    # only nameko server supports the features in this test
+    server_types = ("nameko",)
 
     @pytest.fixture
     def grpc_server(self, start_server):
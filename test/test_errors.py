@@ -172,9 +172,7 @@ class TestMethodException:
 
 
 class TestRaiseGrpcError:
-    @pytest.fixture(params=["server=nameko"])
-    def server_type(self, request):
-        return request.param[7:]
+    server_types = ("nameko",)
 
     def test_error_before_response(self, client, protobufs):
         with pytest.raises(GrpcError) as error:
@@ -232,13 +230,8 @@ class TestErrorViaContext:
 
 
 class TestErrorDetails:
-    @pytest.fixture(params=["client=nameko", "client=dp"])
-    def client_type(self, request):
-        return request.param[7:]
-
-    @pytest.fixture(params=["server=nameko"])
-    def server_type(self, request):
-        return request.param[7:]
+    client_types = ("nameko", "dp")
+    server_types = ("nameko",)
 
     @pytest.fixture(params=[True, False])
     def debug_mode(self, request):
@@ -294,9 +287,7 @@ class TestErrorDetails:
 
 
 class TestCustomErrorFromException:
-    @pytest.fixture(params=["server=nameko"])
-    def server_type(self, request):
-        return request.param[7:]
+    server_types = ("nameko",)
 
     @pytest.fixture(autouse=True)
     def register_exception_handler(self):
@@ -348,9 +339,7 @@ class TestCustomErrorFromException:
 
 
 class TestErrorInvalidRequest:
-    @pytest.fixture(params=["client=nameko"])
-    def client_type(self, request):
-        return request.param[7:]
+    client_types = ("nameko",)
 
     def test_invalid_request(self, client, protobufs):
         with mock.patch(
@@ -364,9 +353,7 @@ class TestErrorInvalidRequest:
 
 
 class TestErrorStreamClosed:
-    @pytest.fixture(params=["client=nameko"])
-    def client_type(self, request):
-        return request.param[7:]
+    client_types = ("nameko",)
 
     def test_response_stream_closed(self, client, protobufs):
         with mock.patch(
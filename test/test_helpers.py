@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+import pytest
+from eventlet.green import zmq
+from google.protobuf import descriptor_pb2
+
+from helpers import RemoteClientTransport
+
+
+class TestRemoteClientTransport:
+    @pytest.fixture
+    def transports(self):
+        context = zmq.Context()
+        sender, endpoint = RemoteClientTransport.bind_to_free_endpoint(
+            context, zmq.PUSH
+        )
+        receiver = RemoteClientTransport.connect(context, zmq.PULL, endpoint)
+        yield sender, receiver
+        # streams close their transports once they're exhausted
+        for transport in (sender, receiver):
+            if not transport.sock.closed:
+                transport.destroy()
+        context.term()
+
+    def test_message(self, transports):
+        sender, receiver = transports
+
+        message = descriptor_pb2.DescriptorProto(name="foo")
+        sender.send(message)
+        assert receiver.receive() == message
+
+    def test_nested_message(self, transports):
+        sender, receiver = transports
+
+        message = descriptor_pb2.DescriptorProto.ExtensionRange(start=3, end=5)
+        sender.send(message)
+        received = receiver.receive()
+        assert type(received) is descriptor_pb2.DescriptorProto.ExtensionRange
+        assert received == message
+
+    def test_stream(self, transports):
+        sender, receiver = transports
+
+        messages = [
+            descriptor_pb2.DescriptorProto.ExtensionRange(start=index)
+            for index in range(3)
+        ]
+        sender.send_stream(iter(messages))
+        assert list(receiver.receive_stream()) == messages
@@ -4,13 +4,6 @@ import subprocess
 import pytest
 
 
-@pytest.fixture(autouse=True, scope="session")
-def interop_protos(compile_proto):
-    compile_proto("empty")
-    compile_proto("messages")
-    compile_proto("interop")
-
-
 @pytest.fixture
 def grpc_server(start_grpc_server):
     return start_grpc_server("TestService", "interop")
@@ -24,12 +17,8 @@ def nameko_server(start_nameko_server):
 @pytest.fixture
 def server(request, server_type):
     if server_type == "grpc":
-        if request.config.option.server not in ("grpc", "all"):
-            pytest.skip("grpc server not requested")
         return request.getfixturevalue("grpc_server")
     if server_type == "nameko":
-        if request.config.option.server not in ("nameko", "all"):
-            pytest.skip("nameko server not requested")
         return request.getfixturevalue("nameko_server")
 
 